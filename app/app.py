@@ -6,11 +6,22 @@ from visualize import draw_heatmap
 from summarize import generate_executive_summary
 from pathlib import Path
 import tempfile
+import hashlib
+import threading
 import json
 from io import BytesIO
 from fpdf import FPDF
 import plotly.express as px
 from visualize import plot_ratios_bar, plot_risk_distribution
+from chunk import detect_headers_footers, clean_text_auto, chunk_text
+from search import RiskIndex
+
+RISK_INDEX_DIR = "out/risk_index"
+RISK_INDEX_COMPACT_AFTER = 5000  # pending vectors before the FAISS snapshot is rewritten
+
+@st.cache_resource
+def get_risk_index() -> RiskIndex:
+    return RiskIndex(RISK_INDEX_DIR)
 
 # -----------------------
 # Page Config
@@ -30,7 +41,9 @@ uploaded = st.file_uploader("Upload prospectus (PDF)", type=["pdf"])
 if uploaded:
     # Save uploaded PDF temporarily
     tf = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    tf.write(uploaded.read())
+    pdf_bytes = uploaded.getvalue()
+    doc_id = hashlib.sha256(pdf_bytes).hexdigest()
+    tf.write(pdf_bytes)
     tf.flush()
     pdf_path = tf.name
 
@@ -42,6 +55,17 @@ if uploaded:
     summary = extract_summary(sections, Path(pdf_path).name)
     exec_summary = generate_executive_summary(summary)
 
+    # Persist risks and chunks once per upload so later sessions can search across prospectuses
+    risk_index = get_risk_index()
+    indexed_key = f"risk_indexed_{doc_id}"
+    if not st.session_state.get(indexed_key):
+        headers_footers = detect_headers_footers(pages)
+        chunks = chunk_text([clean_text_auto(p, headers_footers) for p in pages])
+        risk_index.add_document(doc_id, summary.risks, chunks, source_file=uploaded.name)
+        st.session_state[indexed_key] = True
+        if risk_index.pending >= RISK_INDEX_COMPACT_AFTER:
+            threading.Thread(target=risk_index.compact, daemon=True).start()
+
     st.subheader("📊 Financial Ratios")
     with st.expander("View Ratios Chart"):
         ratios_fig = plot_ratios_bar(summary.ratios)
@@ -104,6 +128,26 @@ if uploaded:
             st.markdown(f"**{r.title}** — {r.category} — severity {r.severity:.2f}")
             st.write(r.excerpt[:300])  # show excerpt
 
+    st.subheader("🔎 Similar Risks in Other Prospectuses")
+    with st.expander("Search Risk Index"):
+        query = st.text_input("Search risks", value=summary.risks[0].title if summary.risks else "")
+        category = st.selectbox("Category", ["any", "market", "liquidity", "operational", "geo", "policy", "ESG", "other"])
+        min_severity = st.slider("Minimum severity", 0.0, 1.0, 0.0, 0.05)
+        if query:
+            hits = risk_index.search(
+                query,
+                k=10,
+                kind="risk",
+                category=None if category == "any" else category,
+                min_severity=min_severity or None,
+                exclude_doc=doc_id
+            )
+            for h in hits:
+                st.markdown(f"**{h['title']}** — {h.get('source_file') or h['doc_id'][:12]} — {h['category']} — severity {h['severity']:.2f} (score {h['score']:.2f})")
+                st.write(h["text"][:300])
+            if not hits:
+                st.write("No matching risks indexed from other prospectuses yet.")
+
     st.subheader("📈 Risk Heatmap")
     with st.expander("View Heatmap"):
         heat_path = draw_heatmap(summary.risks, out_path="out/risk_heatmap.png")
@@ -0,0 +1,549 @@
+# app/search.py
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from models import RiskFactor
+from risk import RISK_KEYLEX
+
+STORE_FILE = "risk_index.sqlite"
+INDEX_FILE = "risk_index.faiss"
+
+# faiss >= 1.11 can memory-map flat indexes; older builds ignore the flag and read into RAM
+_MMAP_FLAG = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+_RECORD_COLUMNS = ("doc_id", "source_file", "kind", "title", "category", "severity", "page", "text")
+
+# ------------------------
+# Embedders
+# ------------------------
+_STOP_WORDS = frozenset("""
+a about above after again against all also an and any are as at be because been before being
+below between both but by can could did do does doing down during each either etc few for from
+further had has have having how however if in into is it its itself may might more most must no
+nor not of off on once only or other otherwise our out over own same shall should so some such
+than that the their them then there these they this those through to too under until up upon us
+very was we were what when where whether which while who whom why will with within without would
+you your
+""".split())
+
+# boilerplate that opens nearly every prospectus risk paragraph ("the Fund may be exposed to the risk that...")
+_FILLER_WORDS = frozenset("""
+fund funds scheme schemes risk risks investor investors investment investments invest invested
+exposed exposure result results resulting affect affected adverse adversely subject unitholder
+unitholders manager result consequently accordingly therefore
+""".split())
+
+# single-word stems from the risk lexicon carry the category signal, so weight them up
+_LEXICON_STEMS = tuple(kw for kws in RISK_KEYLEX.values() for kw in kws if " " not in kw)
+
+def _stem(token: str) -> str:
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+class HashingEmbedder:
+    """
+    Offline fallback embedder: signed feature hashing of content-word unigrams and bigrams.
+    Stop words and prospectus boilerplate are dropped, term counts are log-scaled and
+    risk-lexicon terms are boosted. Deterministic across processes, so stored vectors stay valid.
+    """
+    name = "hashing"
+    version = 2  # bump whenever tokenisation or weighting changes
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    @property
+    def config(self) -> Dict:
+        return {"name": self.name, "version": self.version, "dim": self.dim}
+
+    def _features(self, text: str) -> Dict[str, float]:
+        tokens = [_stem(t) for t in re.findall(r"[a-z][a-z0-9]+", text.lower())]
+        content = [t for t in tokens if t not in _STOP_WORDS and t not in _FILLER_WORDS]
+        counts: Dict[str, float] = {}
+        for t in content:
+            counts[t] = counts.get(t, 0.0) + 1.0
+        for a, b in zip(content, content[1:]):
+            counts[a + " " + b] = counts.get(a + " " + b, 0.0) + 0.5
+        weights = {}
+        for f, tf in counts.items():
+            w = 1.0 + math.log(tf) if tf >= 1.0 else tf
+            if " " not in f and f.startswith(_LEXICON_STEMS):
+                w *= 2.0
+            weights[f] = w
+        return weights
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vecs = np.zeros((len(texts), self.dim), dtype="float32")
+        for i, text in enumerate(texts):
+            for f, w in self._features(text).items():
+                h = int.from_bytes(hashlib.blake2b(f.encode(), digest_size=8).digest(), "little")
+                vecs[i, h % self.dim] += -w if h >> 63 else w
+        return vecs
+
+class SentenceTransformerEmbedder:
+    """
+    Local semantic embeddings via sentence-transformers (optional dependency).
+    Runs offline once the model is in the local Hugging Face cache.
+    """
+    name = "sentence-transformers"
+
+    def __init__(self, model: str = "all-MiniLM-L6-v2"):
+        from sentence_transformers import SentenceTransformer
+        self.model = model
+        self._model = SentenceTransformer(model)
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    @property
+    def config(self) -> Dict:
+        return {"name": self.name, "model": self.model, "dim": self.dim}
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self._model.encode(texts, batch_size=64, show_progress_bar=False), dtype="float32")
+
+class OpenAIEmbedder:
+    """
+    OpenAI embeddings via LangChain (requires OPENAI_API_KEY set).
+    """
+    name = "openai"
+
+    def __init__(self, model: str = "text-embedding-3-small", dim: int = 1536):
+        from langchain_community.embeddings import OpenAIEmbeddings
+        self.model = model
+        self.dim = dim
+        self._client = OpenAIEmbeddings(model=model)
+
+    @property
+    def config(self) -> Dict:
+        return {"name": self.name, "model": self.model, "dim": self.dim}
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self._client.embed_documents(texts), dtype="float32")
+
+def default_embedder():
+    """
+    Local sentence-transformers model if installed and cached, else the hashing embedder.
+    """
+    try:
+        return SentenceTransformerEmbedder()
+    except (ImportError, OSError):
+        return HashingEmbedder()
+
+def _embedder_from_config(config: Dict):
+    if config["name"] == SentenceTransformerEmbedder.name:
+        return SentenceTransformerEmbedder(model=config["model"])
+    if config["name"] == OpenAIEmbedder.name:
+        return OpenAIEmbedder(model=config["model"], dim=config["dim"])
+    return HashingEmbedder(dim=config["dim"])
+
+# ------------------------
+# Storage Helpers
+# ------------------------
+def _fsync_path(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _batches(items: List[int], size: int = 500):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _new_flat_index(dim: int) -> faiss.Index:
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+# ------------------------
+# Risk Index
+# ------------------------
+class RiskIndex:
+    """
+    Persistent cosine-similarity index of risk excerpts and text chunks across prospectuses.
+
+    The directory holds a SQLite store (one row per vector: metadata plus the vector itself),
+    which is the source of truth and is updated one document per transaction, and a FAISS
+    snapshot written by compact(). The snapshot is opened read-only (memory-mapped by default);
+    vectors added since the snapshot sit in a small in-memory index and deleted ones are
+    excluded at search time, so adds and removes never rewrite the whole index.
+
+    Several instances, in one process or many, can share a directory: every call first
+    catches up on changes made by the others. Pages are 1-based for both kinds.
+    """
+
+    def __init__(self, directory: str, embedder=None, mmap: bool = True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._store_path = os.path.join(directory, STORE_FILE)
+        self._index_path = os.path.join(directory, INDEX_FILE)
+        self._mmap = mmap
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+
+        self.records: Dict[int, Dict] = {}
+        self.doc_ids: Dict[str, List[int]] = {}
+        self._base: Optional[faiss.Index] = None
+        self._base_ids: set = set()
+        self._base_dead: set = set()  # snapshot ids whose rows have since been deleted
+        self._base_stat = None
+        self._delta_ids: set = set()
+        self._generation = -1
+
+        self.embedder = self._init_store(embedder)
+        self._delta = _new_flat_index(self.embedder.dim)
+        with self._lock:
+            self._sync()
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self._store_path, timeout=30, isolation_level=None)
+        con.execute("PRAGMA synchronous=FULL")
+        return con
+
+    def _init_store(self, embedder):
+        with closing(self._connect()) as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, doc_id TEXT NOT NULL, source_file TEXT, "
+                "kind TEXT NOT NULL, title TEXT, category TEXT, severity REAL, page INTEGER, "
+                "text TEXT NOT NULL, vector BLOB NOT NULL)"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS records_doc_id ON records (doc_id)")
+            con.execute("INSERT OR IGNORE INTO settings VALUES ('generation', '0')")
+            row = con.execute("SELECT value FROM settings WHERE key = 'embedder'").fetchone()
+            if row is None:
+                embedder = embedder or default_embedder()
+                con.execute("INSERT OR IGNORE INTO settings VALUES ('embedder', ?)", (json.dumps(embedder.config),))
+                # another process may have created the store first
+                row = con.execute("SELECT value FROM settings WHERE key = 'embedder'").fetchone()
+
+        stored = json.loads(row[0])
+        embedder = embedder or _embedder_from_config(stored)
+        if embedder.config != stored:
+            raise ValueError(f"Embedder {embedder.config} does not match the index's embedder {stored}")
+        return embedder
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        vecs = np.ascontiguousarray(self.embedder.embed(texts), dtype="float32")
+        faiss.normalize_L2(vecs)
+        return vecs
+
+    # ------------------------
+    # In-memory State
+    # ------------------------
+    def _snapshot_stat(self):
+        try:
+            st = os.stat(self._index_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _open_base(self, stat):
+        if stat is None:
+            self._base = None
+            self._base_ids = set()
+        else:
+            self._base = faiss.read_index(self._index_path, _MMAP_FLAG if self._mmap else 0)
+            self._base_ids = set(faiss.vector_to_array(self._base.id_map).tolist())
+        self._base_dead = set()
+        self._base_stat = stat
+        # vectors the new snapshot lacks are reloaded into the delta by _sync()
+        self._delta = _new_flat_index(self.embedder.dim)
+        self._delta_ids = set()
+
+    def _forget(self, ids: List[int]):
+        for vid in ids:
+            rec = self.records.pop(vid, None)
+            if rec is None:
+                continue
+            if vid in self._base_ids:
+                self._base_dead.add(vid)
+            doc = self.doc_ids.get(rec["doc_id"], [])
+            if vid in doc:
+                doc.remove(vid)
+            if not doc:
+                self.doc_ids.pop(rec["doc_id"], None)
+        in_delta = [vid for vid in ids if vid in self._delta_ids]
+        if in_delta:
+            self._delta.remove_ids(np.array(in_delta, dtype="int64"))
+            self._delta_ids.difference_update(in_delta)
+
+    def _remember(self, ids: List[int], records: List[Dict], vecs: Optional[np.ndarray]):
+        for vid, rec in zip(ids, records):
+            self.records[vid] = rec
+            self.doc_ids.setdefault(rec["doc_id"], []).append(vid)
+        if vecs is None:
+            return
+        keep = [i for i, vid in enumerate(ids) if vid not in self._base_ids and vid not in self._delta_ids]
+        if keep:
+            self._delta.add_with_ids(vecs[keep], np.array([ids[i] for i in keep], dtype="int64"))
+            self._delta_ids.update(ids[i] for i in keep)
+
+    def _sync(self):
+        """
+        Bring in-memory state up to date with the store and the current snapshot file.
+        Cheap when nothing changed: one stat() and one single-row query.
+        """
+        stat = self._snapshot_stat()
+        with closing(self._connect()) as con:
+            con.execute("BEGIN")
+            try:
+                gen = int(con.execute("SELECT value FROM settings WHERE key = 'generation'").fetchone()[0])
+                if gen == self._generation and stat == self._base_stat:
+                    return
+                if stat != self._base_stat:
+                    self._open_base(stat)
+
+                live = {row[0] for row in con.execute("SELECT id FROM records")}
+                self._forget([vid for vid in self.records if vid not in live])
+                self._base_dead = self._base_ids - live
+                need = sorted(vid for vid in live if vid not in self.records
+                              or (vid not in self._base_ids and vid not in self._delta_ids))
+                for batch in _batches(need):
+                    rows = con.execute(
+                        f"SELECT id, {', '.join(_RECORD_COLUMNS)}, vector FROM records "
+                        f"WHERE id IN ({', '.join('?' * len(batch))})",
+                        batch
+                    ).fetchall()
+                    ids = [row[0] for row in rows]
+                    self._forget([vid for vid in ids if vid in self.records])
+                    records = [dict(zip(_RECORD_COLUMNS, row[1:-1])) for row in rows]
+                    vecs = np.stack([np.frombuffer(row[-1], dtype="float32") for row in rows]) if rows else None
+                    self._remember(ids, records, vecs)
+                self._generation = gen
+            finally:
+                con.execute("COMMIT")
+
+    def _replace(self, doc_id: str, records: List[Dict], vecs: Optional[np.ndarray]):
+        """
+        Swap doc_id's rows in the store for records in one transaction, then apply the change locally.
+        """
+        with closing(self._connect()) as con:
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                gen = int(con.execute("SELECT value FROM settings WHERE key = 'generation'").fetchone()[0])
+                old = [row[0] for row in con.execute("SELECT id FROM records WHERE doc_id = ?", (doc_id,))]
+                con.execute("DELETE FROM records WHERE doc_id = ?", (doc_id,))
+                new = []
+                for i, rec in enumerate(records):
+                    cur = con.execute(
+                        f"INSERT INTO records ({', '.join(_RECORD_COLUMNS)}, vector) "
+                        f"VALUES ({', '.join('?' * (len(_RECORD_COLUMNS) + 1))})",
+                        [rec[c] for c in _RECORD_COLUMNS] + [vecs[i].tobytes()]
+                    )
+                    new.append(cur.lastrowid)
+                con.execute("UPDATE settings SET value = ? WHERE key = 'generation'", (str(gen + 1),))
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+
+        if gen == self._generation:
+            self._forget(old)
+            self._remember(new, records, vecs)
+            self._generation = gen + 1
+        else:
+            # someone else wrote in between; reload their changes along with ours
+            self._sync()
+        return len(old)
+
+    # ------------------------
+    # Public API
+    # ------------------------
+    def __len__(self) -> int:
+        with self._lock:
+            self._sync()
+            return len(self.records)
+
+    def documents(self) -> List[str]:
+        with self._lock:
+            self._sync()
+            return sorted(self.doc_ids)
+
+    @property
+    def pending(self) -> int:
+        """
+        Vectors added or deleted since the last snapshot; compact() folds them in.
+        """
+        with self._lock:
+            return len(self._delta_ids) + len(self._base_dead)
+
+    def add_document(
+        self,
+        doc_id: str,
+        risks: List[RiskFactor],
+        chunks: Optional[List[Dict]] = None,
+        source_file: Optional[str] = None
+    ) -> int:
+        """
+        Index a document's risk factors and (optionally) chunks from chunk_text().
+        doc_id should identify the content (e.g. a hash of the PDF bytes); source_file is for display.
+        Re-adding an existing doc_id replaces its previous entries. Returns number of vectors added.
+        """
+        records = []
+        for r in risks:
+            records.append({
+                "doc_id": doc_id,
+                "source_file": source_file,
+                "kind": "risk",
+                "title": r.title,
+                "category": r.category,
+                "severity": r.severity,
+                "page": r.page,
+                "text": r.excerpt
+            })
+        for c in chunks or []:
+            start_page = c.get("start_page")
+            records.append({
+                "doc_id": doc_id,
+                "source_file": source_file,
+                "kind": "chunk",
+                "title": None,
+                "category": None,
+                "severity": None,
+                # chunk_text pages are 0-based; RiskFactor.page is the printed 1-based page
+                "page": start_page + 1 if start_page is not None else None,
+                "text": c["text"]
+            })
+        # embed outside the lock; it is the slow part and touches no shared state
+        texts = [f"{rec['title']}. {rec['text']}" if rec["title"] else rec["text"] for rec in records]
+        vecs = self._embed(texts) if records else None
+
+        with self._lock:
+            self._replace(doc_id, records, vecs)
+        return len(records)
+
+    def remove_document(self, doc_id: str) -> int:
+        """
+        Drop every vector belonging to doc_id. Returns number of vectors removed.
+        """
+        with self._lock:
+            return self._replace(doc_id, [], None)
+
+    def _allowed_ids(
+        self,
+        kind: Optional[str],
+        category: Optional[str],
+        min_severity: Optional[float],
+        exclude_doc: Optional[str]
+    ) -> List[int]:
+        cat = category.lower() if category else None
+        allowed = []
+        for vid, rec in self.records.items():
+            if kind and rec["kind"] != kind:
+                continue
+            if cat and (rec["category"] or "").lower() != cat:
+                continue
+            if min_severity is not None and (rec["severity"] is None or rec["severity"] < min_severity):
+                continue
+            if exclude_doc and rec["doc_id"] == exclude_doc:
+                continue
+            allowed.append(vid)
+        return allowed
+
+    def search(
+        self,
+        query: str,
+        k: int = 5,
+        kind: Optional[str] = None,
+        category: Optional[str] = None,
+        min_severity: Optional[float] = None,
+        exclude_doc: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Top-k most similar entries to query. Filters (and deletions since the last snapshot)
+        are applied inside FAISS via an id selector, so k results are returned whenever
+        k matching entries exist. Each result is the stored metadata plus "id" and "score".
+        """
+        if k <= 0:
+            return []
+        qvec = self._embed([query])
+
+        with self._lock:
+            self._sync()
+            if not self.records:
+                return []
+
+            params = None
+            limit = len(self.records)
+            if kind or category or min_severity is not None:
+                allowed = self._allowed_ids(kind, category, min_severity, exclude_doc)
+                if not allowed:
+                    return []
+                selector = faiss.IDSelectorBatch(np.array(allowed, dtype="int64"))
+                limit = len(allowed)
+            elif exclude_doc or self._base_dead:
+                # only exclusions: a short deny-list is far cheaper than allowing every other id
+                excluded = list(self._base_dead) + list(self.doc_ids.get(exclude_doc, []))
+                limit -= len(self.doc_ids.get(exclude_doc, []))
+                if limit <= 0:
+                    return []
+                denied = faiss.IDSelectorBatch(np.array(excluded, dtype="int64"))
+                selector = faiss.IDSelectorNot(denied)
+            if limit < len(self.records) or self._base_dead:
+                params = faiss.SearchParameters(sel=selector)
+            k = min(k, limit)
+
+            hits = []
+            for index in (self._base, self._delta):
+                if index is None or not index.ntotal:
+                    continue
+                scores, ids = index.search(qvec, min(k, index.ntotal), params=params)
+                hits.extend((s, vid) for s, vid in zip(scores[0].tolist(), ids[0].tolist()) if vid != -1)
+            hits.sort(key=lambda h: -h[0])
+            return [{"id": vid, "score": score, **self.records[vid]} for score, vid in hits[:k]]
+
+    def similar_risks(self, risk: RiskFactor, doc_id: Optional[str] = None, k: int = 5, **filters) -> List[Dict]:
+        """
+        Risk factors in other prospectuses that resemble the given one.
+        """
+        return self.search(f"{risk.title}. {risk.excerpt}", k=k, kind="risk", exclude_doc=doc_id, **filters)
+
+    def compact(self) -> bool:
+        """
+        Write a fresh FAISS snapshot of every live vector in the store and reopen it.
+        Built without holding the search lock; the file is fsynced and atomically renamed
+        into place, so readers always see a complete snapshot. Returns False if a
+        compaction is already running in this process.
+        """
+        if not self._compact_lock.acquire(blocking=False):
+            return False
+        try:
+            index = _new_flat_index(self.embedder.dim)
+            with closing(self._connect()) as con:
+                con.execute("BEGIN")
+                try:
+                    cur = con.execute("SELECT id, vector FROM records")
+                    while True:
+                        rows = cur.fetchmany(1000)
+                        if not rows:
+                            break
+                        vecs = np.stack([np.frombuffer(row[1], dtype="float32") for row in rows])
+                        index.add_with_ids(vecs, np.array([row[0] for row in rows], dtype="int64"))
+                finally:
+                    con.execute("COMMIT")
+
+            tmp_path = f"{self._index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            faiss.write_index(index, tmp_path)
+            _fsync_path(tmp_path)
+            os.replace(tmp_path, self._index_path)
+            if os.name == "posix":
+                _fsync_path(self.directory)
+
+            with self._lock:
+                self._sync()
+            return True
+        finally:
+            self._compact_lock.release()
@@ -0,0 +1,6 @@
+# tests/conftest.py
+import sys
+from pathlib import Path
+
+# app modules import each other as top-level modules (e.g. `from models import RiskFactor`)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
@@ -0,0 +1,204 @@
+# tests/test_search.py
+import os
+import shutil
+import sqlite3
+import threading
+
+import pytest
+
+pytest.importorskip("faiss")
+pytest.importorskip("pydantic")
+
+from models import RiskFactor
+from search import INDEX_FILE, STORE_FILE, HashingEmbedder, RiskIndex
+
+COUNTERPARTY = RiskFactor(
+    title="Counterparty risk",
+    category="operational",
+    severity=0.7,
+    page=12,
+    excerpt="The Fund may be exposed to the risk that a swap counterparty or broker defaults "
+            "on its obligations, and collateral posted with the counterparty may not be recovered."
+)
+CURRENCY = RiskFactor(
+    title="Currency risk",
+    category="market",
+    severity=0.5,
+    page=13,
+    excerpt="The Fund may be exposed to the risk that the value of its investments will be "
+            "affected by changes in exchange rates between the base currency and other currencies."
+)
+LIQUIDITY = RiskFactor(
+    title="Liquidity risk",
+    category="liquidity",
+    severity=0.3,
+    page=14,
+    excerpt="Some holdings may be illiquid, and large redemption requests could force sales at a discount."
+)
+CHUNKS = [
+    {"text": "Interest rate risk: bond prices fall when interest rates rise.", "start_page": 0},
+    {"text": "The trustee fee is 0.05% per annum of net asset value.", "start_page": 4},
+]
+
+def _open(path, **kwargs):
+    return RiskIndex(str(path), embedder=HashingEmbedder(), **kwargs)
+
+def _ids(hits):
+    return [(h["doc_id"], h["title"]) for h in hits]
+
+@pytest.fixture
+def index(tmp_path):
+    idx = _open(tmp_path)
+    idx.add_document("fund-a", [COUNTERPARTY, CURRENCY], CHUNKS, source_file="a.pdf")
+    idx.add_document("fund-b", [COUNTERPARTY, LIQUIDITY], source_file="b.pdf")
+    return idx
+
+def test_add_replace_remove(index):
+    assert len(index) == 6
+    assert index.documents() == ["fund-a", "fund-b"]
+
+    assert index.add_document("fund-a", [LIQUIDITY]) == 1
+    assert len(index) == 3
+    assert {h["title"] for h in index.search("liquidity", k=10) if h["doc_id"] == "fund-a"} == {"Liquidity risk"}
+
+    assert index.remove_document("fund-a") == 1
+    assert index.remove_document("fund-a") == 0
+    assert index.documents() == ["fund-b"]
+    assert all(h["doc_id"] == "fund-b" for h in index.search("risk", k=10))
+
+def test_chunk_pages_are_one_based(index):
+    hits = index.search("trustee fee net asset value", k=1, kind="chunk")
+    assert hits[0]["page"] == 5
+    assert hits[0]["source_file"] == "a.pdf"
+
+def test_filters(index):
+    assert {h["kind"] for h in index.search("risk", k=10, kind="chunk")} == {"chunk"}
+    assert {h["kind"] for h in index.search("risk", k=10, kind="risk")} == {"risk"}
+    assert _ids(index.search("risk", k=10, category="MARKET")) == [("fund-a", "Currency risk")]
+    assert {h["severity"] for h in index.search("risk", k=10, min_severity=0.5)} == {0.5, 0.7}
+    assert index.search("risk", k=10, category="ESG") == []
+
+    hits = index.similar_risks(COUNTERPARTY, doc_id="fund-a", k=10)
+    assert hits and all(h["doc_id"] == "fund-b" for h in hits)
+
+def test_filtered_search_fills_k(index):
+    hits = index.search("counterparty default", k=2, kind="risk", exclude_doc="fund-b")
+    assert len(hits) == 2
+
+def test_hashing_ranks_topic_over_boilerplate(tmp_path):
+    idx = _open(tmp_path)
+    idx.add_document("fund-a", [CURRENCY, LIQUIDITY])
+    idx.add_document("fund-b", [COUNTERPARTY])
+    query = RiskFactor(
+        title="Counterparty exposure",
+        category="operational",
+        severity=0.6,
+        excerpt="The Fund may be exposed to the risk that a derivative counterparty becomes insolvent."
+    )
+    hits = idx.similar_risks(query, k=3)
+    assert hits[0]["title"] == "Counterparty risk"
+    assert hits[0]["score"] > 2 * hits[1]["score"]
+
+@pytest.mark.parametrize("mmap", [True, False])
+@pytest.mark.parametrize("compacted", [True, False])
+def test_reopen_round_trip(index, tmp_path, mmap, compacted):
+    index.add_document("fund-c", [LIQUIDITY])
+    index.remove_document("fund-b")
+    expected = index.search("counterparty default", k=10)
+    if compacted:
+        assert index.compact()
+        assert index.pending == 0
+        assert os.path.exists(tmp_path / INDEX_FILE)
+
+    reopened = _open(tmp_path, mmap=mmap)
+    assert reopened.documents() == ["fund-a", "fund-c"]
+    assert _ids(reopened.search("counterparty default", k=10)) == _ids(expected)
+
+    # mutating a reopened (possibly memory-mapped) index leaves the snapshot untouched
+    reopened.add_document("fund-d", [CURRENCY])
+    reopened.remove_document("fund-a")
+    assert reopened.documents() == ["fund-c", "fund-d"]
+    assert {h["doc_id"] for h in reopened.search("risk", k=10)} == {"fund-c", "fund-d"}
+    assert {h["doc_id"] for h in reopened.search("risk", k=10, exclude_doc="fund-c")} == {"fund-d"}
+
+def test_snapshot_out_of_step_with_store(index, tmp_path):
+    # a snapshot holding vectors whose rows are gone, plus rows the snapshot never saw
+    index.compact()
+    stale = tmp_path / "stale.faiss"
+    shutil.copy(tmp_path / INDEX_FILE, stale)
+    index.remove_document("fund-a")
+    index.add_document("fund-c", [CURRENCY, LIQUIDITY])
+    index.compact()
+    shutil.copy(stale, tmp_path / INDEX_FILE)
+    (tmp_path / f"{INDEX_FILE}.123.456.tmp").write_bytes(b"partial write")
+
+    reopened = _open(tmp_path)
+    assert reopened.documents() == ["fund-b", "fund-c"]
+    hits = reopened.search("risk", k=4)
+    assert len(hits) == 4
+    assert {h["doc_id"] for h in hits} == {"fund-b", "fund-c"}
+    assert reopened.pending > 0
+
+    reopened.compact()
+    assert reopened.pending == 0
+    assert len(reopened.search("risk", k=10)) == 4
+
+def test_two_instances_share_directory(tmp_path):
+    a = _open(tmp_path)
+    b = _open(tmp_path)
+
+    b.add_document("fund-b", [LIQUIDITY])
+    a.add_document("fund-a", [CURRENCY])
+    assert a.documents() == b.documents() == ["fund-a", "fund-b"]
+
+    hits_a = a.search("currency exchange rates", k=2)
+    hits_b = b.search("currency exchange rates", k=2)
+    assert hits_a[0]["title"] == hits_b[0]["title"] == "Currency risk"
+    assert {h["id"] for h in hits_a} == {h["id"] for h in hits_b}
+    assert len({h["id"] for h in hits_a}) == 2
+
+    a.compact()
+    b.remove_document("fund-a")
+    b.add_document("fund-c", [COUNTERPARTY])
+    assert a.documents() == ["fund-b", "fund-c"]
+    assert a.search("counterparty", k=1)[0]["doc_id"] == "fund-c"
+
+    _open(tmp_path).compact()
+    assert _ids(a.search("risk", k=10)) == _ids(b.search("risk", k=10))
+
+def test_concurrent_threads(tmp_path):
+    idx = _open(tmp_path)
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(5):
+                idx.add_document(f"fund-{n}-{i % 2}", [COUNTERPARTY, CURRENCY], CHUNKS)
+                idx.search("counterparty", k=3, kind="risk")
+            if n == 0:
+                idx.compact()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert len(idx) == 8 * 4
+    with sqlite3.connect(tmp_path / STORE_FILE) as con:
+        assert con.execute("SELECT COUNT(*) FROM records").fetchone()[0] == 32
+
+def test_embedder_mismatch_raises(index, tmp_path):
+    with pytest.raises(ValueError):
+        RiskIndex(str(tmp_path), embedder=HashingEmbedder(dim=256))
+
+    class SameDim(HashingEmbedder):
+        name = "other"
+
+    with pytest.raises(ValueError):
+        RiskIndex(str(tmp_path), embedder=SameDim())
+
+    assert RiskIndex(str(tmp_path)).embedder.config == HashingEmbedder().config